@@ -1,24 +1,66 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from typing import Dict, List
-from functools import wraps
+from functools import lru_cache
+from contextlib import contextmanager, suppress
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from shapely import from_wkt
 from shapely.geometry import Polygon
-import requests
-import time
+import httpx
+import asyncio
 import logging
 import threading
+import re
 import sqlite3
 
 
 DATABASE_FILE = "iss_data.db"
 
+ISS_API_URL = "https://api.wheretheiss.at/v1/satellites/25544"
+
+connection = None
+connection_lock = threading.Lock()
+
+http_client = None
+fetch_task = None
+stop_event = None
+
+last_sun_window = None
+
+latest_position = {}
+
+ISS_FETCH_INTERVAL = 20
+ISS_DATA_FLUSH_SIZE = 1
+ISS_DATA_MAX_PENDING = 1000
+pending_iss_data = []
+
+SELECT_LAST_SUN_WINDOW = "SELECT id, window FROM iss_sun_exposures ORDER BY id DESC LIMIT 1"
+SELECT_SUN_EXPOSURES = '''
+    SELECT timestamp, next_timestamp
+    FROM (
+        SELECT timestamp, window, LEAD(timestamp) OVER (ORDER BY id) AS next_timestamp
+        FROM iss_sun_exposures
+    )
+    WHERE window = 'start'
+'''
+INSERT_SUN_EXPOSURE = "INSERT INTO iss_sun_exposures (timestamp, window) VALUES (?, ?)"
+DELETE_SUN_EXPOSURE = "DELETE FROM iss_sun_exposures WHERE id = ?"
+SELECT_LAST_POSITION = "SELECT latitude, longitude FROM iss_positions ORDER BY id DESC LIMIT 1"
+INSERT_POSITION = "INSERT INTO iss_positions (timestamp, latitude, longitude) VALUES (?, ?, ?)"
+SELECT_POLYGONS = "SELECT json_object('uuid', uuid, 'color', color, 'wkt', wkt) FROM polygons"
+SELECT_POLYGON = "SELECT uuid, color, wkt FROM polygons WHERE uuid = ?"
+INSERT_POLYGON = "INSERT INTO polygons (uuid, color, wkt) VALUES (?, ?, ?) RETURNING uuid"
+DELETE_POLYGON = "DELETE FROM polygons WHERE uuid = ? RETURNING uuid"
+
+WKT_MAX_LENGTH = 65536
+WKT_POLYGON_PATTERN = re.compile(r"^\s*POLYGON\s*\(\s*\(", re.IGNORECASE)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("fastapi")
 
-app = FastAPI(version="0.0.1")
+app = FastAPI(version="0.0.1", default_response_class=ORJSONResponse)
 
 
 app.add_middleware(
@@ -32,154 +74,319 @@ app.add_middleware(
 
 class PolygonRequest(BaseModel):
     uuid: str
-    wkt: str
+    wkt: str = Field(max_length=WKT_MAX_LENGTH)
     color: str
 
 
-def log(func):
+class MessageResponse(BaseModel):
+    message: str
+
+
+class HealthResponse(BaseModel):
+    status: str
+
+
+class LogRequestsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        path = scope['path']
+
+        status_code = None
 
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
+        async def send_with_status(message):
+
+            nonlocal status_code
+
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+
+            await send(message)
+
+        logger.info("Calling endpoint: %s", path)
 
         try:
 
-            logger.info(f"Calling endpoint: {func.__name__}")
+            await self.app(scope, receive, send_with_status)
+
+        except Exception:
+
+            logger.error("Error calling endpoint: %s", path, exc_info=True)
+
+            if status_code is not None:
+                raise
+
+            response = ORJSONResponse(
+                {'message': 'An error occured'}, status_code=500)
+
+            return await response(scope, receive, send)
+
+        if status_code < 400:
+            logger.info("Success calling endpoint: %s", path)
+        else:
+            logger.warning("Error response %s calling endpoint: %s",
+                           status_code, path)
+
+
+app.add_middleware(LogRequestsMiddleware)
+
+
+def get_connection() -> sqlite3.Connection:
+
+    global connection
+
+    if connection is None:
+
+        connection = sqlite3.connect(
+            DATABASE_FILE, check_same_thread=False, cached_statements=512)
+
+        connection.row_factory = sqlite3.Row
+
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-64000")
+        connection.execute("PRAGMA mmap_size=268435456")
+        connection.execute("PRAGMA wal_autocheckpoint=1000")
 
-            result = await func(*args, **kwargs)
+    return connection
 
-            logger.info(f"Success calling endpoint: {func.__name__}")
 
-            return result
+def close_connection():
 
-        except:
+    global connection
 
-            logger.error(
-                f"Error calling endpoint: {func.__name__}", exc_info=True)
+    with connection_lock:
 
-            return {'message': 'An error occured'}
+        if connection is not None:
 
-    return wrapper
+            try:
+
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+            except sqlite3.OperationalError:
+
+                logger.warning("WAL checkpoint skipped at shutdown", exc_info=True)
+
+            finally:
+
+                connection.close()
+
+                connection = None
+
+
+@contextmanager
+def database():
+
+    with connection_lock:
+
+        conn = get_connection()
+
+        try:
+
+            yield conn
+
+        except Exception:
+
+            conn.rollback()
+
+            raise
 
 
 def init_database():
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS iss_positions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT,
-            latitude REAL,
-            longitude REAL
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS iss_sun_exposures (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT,
-            window TEXT
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS polygons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uuid TEXT UNIQUE,
-            color TEXT,
-            wkt TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-
-def select(query: str, *args) -> List:
-
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute(query, *args)
-
-    rows = cursor.fetchall()
-
-    conn.close()
+
+    with database() as conn:
+
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS iss_positions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                latitude REAL,
+                longitude REAL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS iss_sun_exposures (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                window TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS polygons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uuid TEXT UNIQUE,
+                color TEXT,
+                wkt TEXT
+            )
+        ''')
+        conn.commit()
+
+
+def sync_select(query: str, *args) -> List:
+
+    with database() as conn:
+
+        cursor = conn.cursor()
+
+        cursor.execute(query, *args)
+
+        rows = cursor.fetchall()
 
     return rows
 
 
-def cud_operation(query: str, *args) -> List:
+def sync_cud_operation(query: str, *args) -> List:
+
+    with database() as conn:
+
+        cursor = conn.cursor()
+
+        cursor.execute(query, *args)
+
+        returned_rows = cursor.fetchall()
+
+        conn.commit()
 
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    return returned_rows
 
-    cursor.execute(query, *args)
 
-    affected_rows = cursor.rowcount
+async def select(query: str, *args) -> List:
 
-    conn.commit()
+    return await asyncio.to_thread(sync_select, query, *args)
 
-    conn.close()
 
-    return affected_rows
+async def cud_operation(query: str, *args) -> List:
 
+    return await asyncio.to_thread(sync_cud_operation, query, *args)
 
-def fetch_iss_data():
 
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+def insert_iss_data(batch: List[Dict]):
 
-    while True:
+    global last_sun_window
+
+    with database() as conn:
+
+        cursor = conn.cursor()
+
+        if last_sun_window is None:
+
+            cursor.execute(SELECT_LAST_SUN_WINDOW)
+
+            row = cursor.fetchone()
+
+            last_sun_window = row[1] if row else 'end'
+
+        sun_window = last_sun_window
+
+        cursor.executemany(INSERT_POSITION, [
+            (data['timestamp'], data['latitude'], data['longitude']) for data in batch])
+
+        for data in batch:
+
+            if data['visibility'] == 'daylight':
+
+                if sun_window == 'end':
+
+                    cursor.execute(INSERT_SUN_EXPOSURE, (
+                        data['timestamp'], 'start'))
+
+                    sun_window = 'start'
+
+            else:
+
+                if sun_window == 'start':
+
+                    cursor.execute(INSERT_SUN_EXPOSURE, (
+                        data['timestamp'], 'end'))
+
+                    sun_window = 'end'
+
+        conn.commit()
+
+        last_sun_window = sun_window
+
+
+def parse_iss_data(data: Dict) -> Dict:
+
+    return {
+        'timestamp': int(data['timestamp']),
+        'latitude': float(data['latitude']),
+        'longitude': float(data['longitude']),
+        'visibility': str(data['visibility'])
+    }
+
+
+async def flush_iss_data():
+
+    global pending_iss_data
+
+    if pending_iss_data:
+
+        batch, pending_iss_data = pending_iss_data, []
 
         try:
 
-            logger.info("Fetching wheretheiss api")
+            await asyncio.to_thread(insert_iss_data, batch)
 
-            url = "https://api.wheretheiss.at/v1/satellites/25544"
+        except sqlite3.OperationalError:
 
-            headers = {"accept": "application/json"}
+            pending_iss_data = (batch + pending_iss_data)[-ISS_DATA_MAX_PENDING:]
 
-            with requests.get(url, headers=headers) as response:
+            raise
 
-                response.raise_for_status()
 
-                data = response.json()
+async def fetch_iss_data():
 
-                cursor.execute(
-                    "SELECT window FROM iss_sun_exposures ORDER BY id DESC LIMIT 1")
+    global latest_position
 
-                sun_exposure = cursor.fetchone()
+    while not stop_event.is_set():
 
-                cursor.execute("INSERT INTO iss_positions (timestamp, latitude, longitude) VALUES (?, ?, ?)", (
-                    data['timestamp'], data['latitude'], data['longitude']))
+        try:
 
-                if data['visibility'] == 'daylight':
+            logger.info("Fetching wheretheiss api")
 
-                    if not sun_exposure or sun_exposure[0] == 'end':
+            response = await http_client.get(ISS_API_URL)
 
-                        cursor.execute("INSERT INTO iss_sun_exposures (timestamp, window) VALUES (?, ?)", (
-                            data['timestamp'], 'start'))
+            response.raise_for_status()
 
-                else:
+            data = parse_iss_data(response.json())
 
-                    if sun_exposure and sun_exposure[0] == 'start':
+            pending_iss_data.append(data)
 
-                        cursor.execute("INSERT INTO iss_sun_exposures (timestamp, window) VALUES (?, ?)", (
-                            data['timestamp'], 'end'))
+            latest_position = {
+                "latitude": data['latitude'],
+                "longitude": data['longitude']
+            }
 
-                conn.commit()
+            if len(pending_iss_data) >= ISS_DATA_FLUSH_SIZE:
+                await flush_iss_data()
 
-        except requests.RequestException:
+        except httpx.HTTPError:
 
             logger.error("HTTPError at fetching ISS data", exc_info=True)
 
-        except:
+        except Exception:
 
             logger.error("Unknown error at fetching ISS data", exc_info=True)
 
-        finally:
-
-            time.sleep(20)
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop_event.wait(), ISS_FETCH_INTERVAL)
 
 
+@lru_cache(maxsize=1024)
 def is_valid_2d_wkt_polygon(wkt):
+
+    if not WKT_POLYGON_PATTERN.match(wkt) or wkt.count('(') != wkt.count(')'):
+        return False
+
     try:
 
         geometry = from_wkt(wkt)
@@ -194,7 +401,7 @@ def is_valid_2d_wkt_polygon(wkt):
 
             return False
 
-    except:
+    except Exception:
 
         logger.error('Eror at validating polygon', exc_info=True)
 
@@ -202,143 +409,188 @@ def is_valid_2d_wkt_polygon(wkt):
 
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+
+    global http_client, fetch_task, stop_event
+
     init_database()
-    thread = threading.Thread(target=fetch_iss_data)
-    thread.daemon = True
-    thread.start()
+
+    http_client = httpx.AsyncClient(
+        headers={"accept": "application/json"},
+        timeout=10,
+        transport=httpx.AsyncHTTPTransport(http2=True, retries=2))
+
+    stop_event = asyncio.Event()
+
+    fetch_task = asyncio.create_task(fetch_iss_data())
 
 
 @app.on_event("shutdown")
-def shutdown_event():
+async def shutdown_event():
 
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    global last_sun_window
 
-    cursor.execute(
-        "SELECT id, window FROM iss_sun_exposures ORDER BY id DESC LIMIT 1")
+    stop_event.set()
 
-    row = cursor.fetchone()
+    with suppress(asyncio.TimeoutError, asyncio.CancelledError):
+        await asyncio.wait_for(fetch_task, 5)
 
-    if row and row[1] == 'start':
+    await http_client.aclose()
 
-        cursor.execute(
-            "DELETE FROM iss_sun_exposures WHERE id = ?", (row[0], ))
+    try:
 
-        conn.commit()
+        await flush_iss_data()
 
-    conn.close()
+    except Exception:
 
+        logger.error("Error at flushing ISS data on shutdown", exc_info=True)
 
-@app.get("/health", response_model=Dict[str, str])
-@log
-async def get_health():
-    return {"status": "online"}
+    try:
 
+        with database() as conn:
 
-@app.get("/iss/sun", response_model=Dict[str, List[Dict[str, str]] | str])
-@log
-async def get_iss_sun_exposures():
+            cursor = conn.cursor()
 
-    result = []
+            cursor.execute(SELECT_LAST_SUN_WINDOW)
 
-    rows = select(
-        "SELECT timestamp, window FROM iss_sun_exposures ORDER BY id ASC")
+            row = cursor.fetchone()
 
-    for i in range(0, len(rows) - 1, 2):
+            if row and row[1] == 'start':
 
-        row = rows[i]
-        next_row = rows[i+1]
+                cursor.execute(DELETE_SUN_EXPOSURE, (row[0], ))
 
-        assert (row[1] == 'start')
-        assert (next_row[1] == 'end')
+                conn.commit()
 
-        result.append({
-            'start': row[0],
-            'end': next_row[0]
-        })
+    finally:
+
+        last_sun_window = None
+
+        close_connection()
+
+
+@app.get("/health", response_model=HealthResponse)
+async def get_health():
+    return {"status": "online"}
 
-    if len(rows) != 0 and rows[-1][1] == 'start':
-        result.append({
-            'start': rows[-1][0],
-            'end': int(datetime.now().timestamp())
-        })
+
+@app.get("/iss/sun")
+async def get_iss_sun_exposures():
+
+    rows = await select(SELECT_SUN_EXPOSURES)
 
     return {
-        "sun_exposures": result
+        "sun_exposures": [{
+            'start': row[0],
+            'end': row[1] if row[1] is not None else str(int(datetime.now().timestamp()))
+        } for row in rows]
     }
 
 
-@app.get("/iss/position", response_model=Dict[str, float | str])
-@log
+@app.get("/iss/position")
 async def get_iss_position():
 
-    rows = select(
-        "SELECT latitude, longitude FROM iss_positions ORDER BY id DESC LIMIT 1")
+    global latest_position
 
-    if len(rows):
+    if not latest_position:
 
-        return {
-            "latitude": rows[0][0],
-            "longitude": rows[0][1]
-        }
+        rows = await select(SELECT_LAST_POSITION)
 
-    return {"message": "No position data available"}
+        if len(rows) and not latest_position:
 
+            latest_position = dict(rows[0])
 
-@app.post("/2d-polygons", response_model=Dict[str, str])
-@log
+    return latest_position or {"message": "No position data available"}
+
+
+@app.post("/2d-polygons", response_model=MessageResponse)
 async def post_2d_polygon(polygon: PolygonRequest):
 
     if is_valid_2d_wkt_polygon(polygon.wkt):
 
-        if cud_operation("INSERT INTO polygons (uuid, color, wkt) VALUES (?, ?, ?)",
-                         (polygon.uuid, polygon.color, polygon.wkt)):
+        try:
+
+            rows = await cud_operation(INSERT_POLYGON, (polygon.uuid, polygon.color, polygon.wkt))
+
+        except sqlite3.IntegrityError:
 
-            return {'message': polygon.uuid}
+            rows = []
+
+        if len(rows):
+
+            return {'message': rows[0][0]}
 
         return {'message': 'No affected rows'}
 
     return {'message': "The wkt string is not a valid 2D polygon"}
 
 
-@app.delete("/2d-polygons/{uuid}", response_model=Dict[str, str])
-@log
+@app.delete("/2d-polygons/{uuid}", response_model=MessageResponse)
 async def delete_2d_polygon(uuid: str):
 
-    if cud_operation("DELETE FROM polygons WHERE uuid = ?", (uuid,)):
+    rows = await cud_operation(DELETE_POLYGON, (uuid,))
 
-        return {'message': uuid}
+    if len(rows):
+
+        return {'message': rows[0][0]}
 
     return {'message': 'No affected rows'}
 
 
-@app.get("/2d-polygons", response_model=Dict[str, List[Dict[str, str]] | str])
-@log
-async def get_2d_polygons():
+def open_reader() -> sqlite3.Connection:
 
-    rows = select(
-        "SELECT uuid, color, wkt FROM polygons")
+    with database():
 
-    return {
-        "polygons": [{'uuid': row[0], 'color': row[1], 'wkt': row[2]} for row in rows]
-    }
+        reader = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+
+    reader.execute("PRAGMA query_only=ON")
+
+    return reader
+
+
+async def stream_2d_polygons():
+
+    reader = await asyncio.to_thread(open_reader)
+
+    try:
+
+        cursor = await asyncio.to_thread(reader.execute, SELECT_POLYGONS)
+
+        yield b'{"polygons":['
+
+        separator = b''
+
+        while True:
+
+            rows = await asyncio.to_thread(cursor.fetchmany, 500)
+
+            if not rows:
+                break
+
+            yield separator + ','.join(row[0] for row in rows).encode()
+
+            separator = b','
+
+        yield b']}'
+
+    finally:
+
+        await asyncio.to_thread(reader.close)
+
+
+@app.get("/2d-polygons")
+async def get_2d_polygons():
+
+    return StreamingResponse(stream_2d_polygons(), media_type="application/json")
 
 
-@app.get("/2d-polygons/{uuid}", response_model=Dict[str,  str])
-@log
-async def get_2d_polygons(uuid: str):
+@app.get("/2d-polygons/{uuid}")
+async def get_2d_polygon_by_uuid(uuid: str):
 
-    rows = select(
-        "SELECT uuid, color, wkt FROM polygons WHERE uuid = ?", (uuid,))
+    rows = await select(SELECT_POLYGON, (uuid,))
 
     if len(rows):
 
-        return {
-            "uuid": rows[0][0],
-            "color": rows[0][1],
-            "wkt": rows[0][2]
-        }
+        return dict(rows[0])
 
     return {"message": "No polygon with the given uuid exists"}
 
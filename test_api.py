@@ -1,5 +1,11 @@
 from fastapi.testclient import TestClient
 from api import app
+import api
+import asyncio
+import httpx
+import orjson
+import pytest
+import sqlite3
 
 client = TestClient(app)
 
@@ -17,6 +23,21 @@ polygon2 = {
 }
 
 
+@pytest.fixture
+def temp_database(tmp_path, monkeypatch):
+
+    api.close_connection()
+
+    monkeypatch.setattr(api, 'DATABASE_FILE', str(tmp_path / 'iss_data.db'))
+    monkeypatch.setattr(api, 'last_sun_window', None)
+
+    api.init_database()
+
+    yield
+
+    api.close_connection()
+
+
 def test_health():
     response = client.get("/health")
 
@@ -39,6 +60,143 @@ def test_iss_sun_exposures():
         assert data == []
 
 
+def test_iss_sun_exposures_pairs(temp_database):
+
+    for timestamp, window in [('1', 'start'), ('2', 'end'), ('3', 'start'), ('4', 'end'), ('5', 'start')]:
+        api.sync_cud_operation(api.INSERT_SUN_EXPOSURE, (timestamp, window))
+
+    response = client.get("/iss/sun")
+
+    assert response.status_code == 200
+
+    sun_exposures = response.json()['sun_exposures']
+
+    assert sun_exposures[:2] == [
+        {'start': '1', 'end': '2'}, {'start': '3', 'end': '4'}]
+
+    # trailing open window ends now
+
+    assert sun_exposures[2]['start'] == '5'
+
+    assert int(sun_exposures[2]['end']) > 5
+
+    assert len(sun_exposures) == 3
+
+
+def test_insert_iss_data(temp_database):
+
+    batch = [
+        {'timestamp': 1, 'latitude': 1.0, 'longitude': 2.0, 'visibility': 'daylight'},
+        {'timestamp': 2, 'latitude': 1.0, 'longitude': 2.0, 'visibility': 'daylight'},
+        {'timestamp': 3, 'latitude': 1.0, 'longitude': 2.0, 'visibility': 'eclipsed'},
+        {'timestamp': 4, 'latitude': 1.0, 'longitude': 2.0, 'visibility': 'daylight'}
+    ]
+
+    api.insert_iss_data(batch)
+
+    rows = api.sync_select("SELECT timestamp, window FROM iss_sun_exposures ORDER BY id")
+
+    assert [tuple(row) for row in rows] == [
+        ('1', 'start'), ('3', 'end'), ('4', 'start')]
+
+    assert api.sync_select("SELECT COUNT(*) FROM iss_positions")[0][0] == 4
+
+    assert api.last_sun_window == 'start'
+
+
+def test_fetch_iss_data_skips_malformed_payload(temp_database, monkeypatch):
+
+    payloads = [
+        {'timestamp': 1, 'latitude': 1.0, 'longitude': 2.0},
+        {'timestamp': 2, 'latitude': 1.0, 'longitude': 2.0, 'visibility': 'daylight'},
+        {'timestamp': 3, 'latitude': 1.0, 'longitude': 2.0, 'visibility': 'eclipsed'}
+    ]
+
+    async def run():
+
+        def handler(request):
+
+            if len(payloads) == 1:
+                api.stop_event.set()
+
+            return httpx.Response(200, json=payloads.pop(0))
+
+        api.stop_event = asyncio.Event()
+        api.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        await api.fetch_iss_data()
+
+        await api.http_client.aclose()
+
+    monkeypatch.setattr(api, 'ISS_FETCH_INTERVAL', 0)
+    monkeypatch.setattr(api, 'pending_iss_data', [])
+    monkeypatch.setattr(api, 'stop_event', None)
+    monkeypatch.setattr(api, 'http_client', None)
+
+    asyncio.run(run())
+
+    assert api.pending_iss_data == []
+
+    assert api.sync_select("SELECT COUNT(*) FROM iss_positions")[0][0] == 2
+
+    rows = api.sync_select("SELECT timestamp, window FROM iss_sun_exposures ORDER BY id")
+
+    assert [tuple(row) for row in rows] == [('2', 'start'), ('3', 'end')]
+
+
+def test_flush_iss_data_requeues_on_operational_error(temp_database, monkeypatch):
+
+    def locked(batch):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(api, 'insert_iss_data', locked)
+    monkeypatch.setattr(api, 'pending_iss_data', [{'timestamp': 1}])
+
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(api.flush_iss_data())
+
+    assert api.pending_iss_data == [{'timestamp': 1}]
+
+
+def test_server_error(monkeypatch):
+
+    async def failing_select(query, *args):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(api, 'select', failing_select)
+
+    response = client.get("/iss/sun")
+
+    assert response.status_code == 500
+
+    assert response.json() == {'message': 'An error occured'}
+
+
+def test_shutdown_after_failed_flush(temp_database, monkeypatch):
+
+    def locked(batch):
+        raise sqlite3.OperationalError('database is locked')
+
+    api.sync_cud_operation(api.INSERT_SUN_EXPOSURE, ('1', 'start'))
+
+    monkeypatch.setattr(api, 'insert_iss_data', locked)
+    monkeypatch.setattr(api, 'pending_iss_data', [{'timestamp': 2}])
+
+    async def run():
+
+        monkeypatch.setattr(api, 'stop_event', asyncio.Event())
+        monkeypatch.setattr(api, 'fetch_task', asyncio.create_task(asyncio.sleep(0)))
+        monkeypatch.setattr(api, 'http_client', httpx.AsyncClient())
+
+        await api.shutdown_event()
+
+    asyncio.run(run())
+
+    assert api.connection is None
+
+    assert api.sync_select("SELECT COUNT(*) FROM iss_sun_exposures")[0][0] == 0
+
+
 def test_iss_position():
     response = client.get("/iss/position")
 
@@ -58,6 +216,14 @@ def test_post_2d_polygon():
 
     assert response.json() == {'message': polygon1['uuid']}
 
+    # duplicate uuid
+
+    response = client.post('/2d-polygons', json=polygon1)
+
+    assert response.status_code == 200
+
+    assert response.json() == {'message': 'No affected rows'}
+
     # not valid polygon wkt
 
     response = client.post(
@@ -68,6 +234,23 @@ def test_post_2d_polygon():
     assert response.json() == {
         'message': "The wkt string is not a valid 2D polygon"}
 
+    # 3D polygon wkt
+
+    response = client.post(
+        '/2d-polygons', json={'uuid': '1', 'color': '#fffff', 'wkt': 'POLYGON Z ((0 0 1, 1 0 1, 1 1 1, 0 0 1))'})
+
+    assert response.status_code == 200
+
+    assert response.json() == {
+        'message': "The wkt string is not a valid 2D polygon"}
+
+    # wkt too long
+
+    response = client.post(
+        '/2d-polygons', json={'uuid': '1', 'color': '#fffff', 'wkt': 'POLYGON((' + '0 0,' * api.WKT_MAX_LENGTH + '0 0))'})
+
+    assert response.status_code == 422
+
     # not valid param
 
     response = client.post(
@@ -76,6 +259,40 @@ def test_post_2d_polygon():
     assert response.status_code == 422
 
 
+def test_is_valid_2d_wkt_polygon():
+
+    assert api.is_valid_2d_wkt_polygon('POLYGON ( (0 0, 1 0, 1 1, 0 0))')
+
+    assert api.is_valid_2d_wkt_polygon('POLYGON(\n(0 0, 1 0, 1 1, 0 0))')
+
+    assert not api.is_valid_2d_wkt_polygon('POLYGON ((0 0, 1 0, 1 1, 0 0)')
+
+    assert not api.is_valid_2d_wkt_polygon('POINT (1 1)')
+
+
+def test_stream_2d_polygons_snapshot(temp_database):
+
+    for i in range(600):
+        api.sync_cud_operation(api.INSERT_POLYGON, (str(i), 'red', 'wkt'))
+
+    async def consume():
+
+        stream = api.stream_2d_polygons()
+
+        chunks = [await stream.__anext__(), await stream.__anext__()]
+
+        api.sync_cud_operation("DELETE FROM polygons")
+
+        async for chunk in stream:
+            chunks.append(chunk)
+
+        return b''.join(chunks)
+
+    polygons = orjson.loads(asyncio.run(consume()))['polygons']
+
+    assert [polygon['uuid'] for polygon in polygons] == [str(i) for i in range(600)]
+
+
 def test_delete_2d_polygon():
 
     uuid = polygon1['uuid']